@@ -1,24 +1,40 @@
 import os
+import asyncio
+import hashlib
+import threading
+import aiosqlite
+import httpx
+import tiktoken
+from cachetools import TTLCache
 from datetime import datetime
+from functools import lru_cache
 from typing import TypedDict, Annotated, Sequence
 from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, ToolMessage
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+import faiss
 from langchain_core.tools import tool
 from langchain_core.documents import Document
 from langgraph.graph import StateGraph, END
-from langgraph.checkpoint.memory import MemorySaver
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.prebuilt import ToolNode
 from operator import add as add_messages
 from dotenv import load_dotenv
+from embeddings import CachedEmbeddings, VectorSidecar
 
 load_dotenv()
 # ===================== 1. SETUP & CONFIG =====================
 # In-memory store for drafts (simulating session_state)
 # Key = session_id, Value = draft_text
-DRAFT_STORE = {}
+# Bounded with a TTL so abandoned sessions age out instead of leaking
+# memory in a long-running server. Writes are lock-guarded since FastAPI
+# handlers and the scheduler thread may race.
+DRAFT_STORE = TTLCache(maxsize=10_000, ttl=24 * 3600)
+DRAFT_LOCK = threading.Lock()
 
 # Always resolve paths relative to this file (so it works no matter
 # where Uvicorn is started from, e.g. project root vs backend folder)
@@ -28,53 +44,168 @@ HISTORY_DIR = os.path.join(BASE_DIR, "maintenance_history_db")
 MANUAL_DIR = os.path.join(BASE_DIR, "maintenance_manual_db")
 PDF_PATH = os.path.join(BASE_DIR, "Maintenance_Conveyor.pdf")
 
-embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-llm = ChatOpenAI(model="gpt-4o", temperature=0.1)
+# One pooled HTTP/2 client shared by chat and embedding calls: keep-alive
+# skips the per-request TCP/TLS handshake and HTTP/2 multiplexes concurrent
+# chat + embedding traffic over a single socket
+http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=60,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+)
+
+# Cached+batched variant: repeat queries hit a local TTL cache, concurrent
+# misses are debounced into a single embeddings API call
+embeddings = CachedEmbeddings(model="text-embedding-3-small", http_async_client=http_client)
+llm = ChatOpenAI(model="gpt-4o", temperature=0.1, http_async_client=http_client)
+
+# Restart-proof (content hash -> vector) store for work-order ingestion
+vector_sidecar = VectorSidecar(os.path.join(BASE_DIR, "vector_cache.sqlite3"))
 
 # ===================== 2. VECTOR STORES (RAG) =====================
-# Initialize Manual Retriever
-if os.path.exists(PDF_PATH):
-    # Only process if DB doesn't exist to save time
-    if not os.path.exists(MANUAL_DIR):
+# Manual Retriever
+# Ingestion no longer runs at import time: main.py schedules init_manual()
+# as a startup background task so Uvicorn binds the port immediately.
+manual_retriever = None
+
+# Sidecar hash of the PDF: re-ingest only when the manual actually changed
+# (previously an updated PDF required deleting the DB folder by hand)
+PDF_HASH_FILE = os.path.join(MANUAL_DIR, ".pdf_sha256")
+
+def _ingest_manual():
+    """Builds (or reopens) the manual vector store and retriever."""
+    global manual_retriever
+
+    if not os.path.exists(PDF_PATH):
+        print(f"[WARN] Manual PDF not found at path: {PDF_PATH}")
+        return
+
+    with open(PDF_PATH, "rb") as f:
+        pdf_hash = hashlib.sha256(f.read()).hexdigest()
+
+    stored_hash = None
+    if os.path.exists(PDF_HASH_FILE):
+        with open(PDF_HASH_FILE) as f:
+            stored_hash = f.read().strip()
+
+    # Only process if the stored DB was built from this exact PDF
+    if stored_hash != pdf_hash:
         print("[INFO] Ingesting manual PDF from:", PDF_PATH)
         loader = PyPDFLoader(PDF_PATH)
         docs = loader.load()
-        splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=100)
+        # Token-based chunks sized to the embedding model's budget: fewer,
+        # fuller chunks than character counting, so less API cost and noise
+        splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            encoding_name="cl100k_base",
+            chunk_size=512,
+            chunk_overlap=64,
+            separators=["\n\n", "\n", ". ", " ", ""],
+        )
         splits = splitter.split_documents(docs)
-        vectorstore_manual = Chroma.from_documents(splits, embeddings, persist_directory=MANUAL_DIR)
+        # Drop duplicate chunks (repeated headers/footers are common in manuals)
+        seen = set()
+        unique_splits = []
+        for d in splits:
+            h = hashlib.md5(d.page_content.encode()).hexdigest()
+            if h not in seen:
+                seen.add(h)
+                unique_splits.append(d)
+        splits = unique_splits
+
+        # Pre-embed in token-budget batches (one API call per batch, capped
+        # under the 8191-token request limit), then load Chroma with the
+        # precomputed vectors so ingestion never re-embeds chunk-by-chunk
+        enc = tiktoken.get_encoding("cl100k_base")
+        batches = []
+        cur, cur_tokens = [], 0
+        for d in splits:
+            n_tokens = len(enc.encode(d.page_content))
+            if cur and (cur_tokens + n_tokens > 7500 or len(cur) >= 500):
+                batches.append(cur)
+                cur, cur_tokens = [], 0
+            cur.append(d)
+            cur_tokens += n_tokens
+        if cur:
+            batches.append(cur)
+
+        vectors = []
+        for batch in batches:
+            vectors.extend(embeddings.embed_documents([d.page_content for d in batch]))
+
+        # A hash mismatch means the store holds chunks of the previous
+        # PDF: drop the collection first so stale content can't linger
+        # alongside the new chunks after a manual update
+        vectorstore_manual = Chroma(persist_directory=MANUAL_DIR, embedding_function=embeddings)
+        if stored_hash is not None:
+            vectorstore_manual.delete_collection()
+            vectorstore_manual = Chroma(persist_directory=MANUAL_DIR, embedding_function=embeddings)
+        vectorstore_manual._collection.upsert(  # type: ignore[attr-defined]
+            ids=[hashlib.md5(d.page_content.encode()).hexdigest() for d in splits],
+            embeddings=vectors,
+            documents=[d.page_content for d in splits],
+            metadatas=[d.metadata for d in splits],
+        )
+
+        with open(PDF_HASH_FILE, "w") as f:
+            f.write(pdf_hash)
     else:
         vectorstore_manual = Chroma(persist_directory=MANUAL_DIR, embedding_function=embeddings)
-    
+
     manual_retriever = vectorstore_manual.as_retriever(search_kwargs={"k": 2})
-else:
-    print(f"[WARN] Manual PDF not found at path: {PDF_PATH}")
-    manual_retriever = None
+
+async def init_manual():
+    """Runs manual ingestion off the event loop (scheduled at app startup)."""
+    await asyncio.to_thread(_ingest_manual)
 
 # Initialize History Retriever
+# History grows over time, so it lives in FAISS (exact IndexFlatIP search,
+# milliseconds even at 100k vectors) instead of Chroma's brute-force scan.
+# The manual stays on Chroma above since it is tiny and immutable.
 if not os.path.exists(HISTORY_DIR):
     os.makedirs(HISTORY_DIR)
-vectorstore_history = Chroma(persist_directory=HISTORY_DIR, embedding_function=embeddings)
+
+try:
+    vectorstore_history = FAISS.load_local(
+        HISTORY_DIR, embeddings, allow_dangerous_deserialization=True
+    )
+except Exception:
+    # First run (or no saved index yet): start from an empty exact-search index
+    index = faiss.IndexFlatIP(1536)  # text-embedding-3-small dimension
+    vectorstore_history = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+    )
+
+def persist_history():
+    """Saves the FAISS history index to disk. Call after every add."""
+    vectorstore_history.save_local(HISTORY_DIR)
+
+def iter_history_documents():
+    """Returns all stored history Documents (FAISS has no metadata query API)."""
+    return list(vectorstore_history.docstore._dict.values())
 
 
 # ===================== 3. TOOLS =====================
 @tool
-def retriever_tool(query: str) -> str:
+async def retriever_tool(query: str) -> str:
     """Search the machine manual for technical specs and procedures."""
     if not manual_retriever: return "Manual not found."
-    docs = manual_retriever.invoke(query)
+    docs = await manual_retriever.ainvoke(query)
     return "\n".join([d.page_content for d in docs])
 
 @tool
-def query_past_orders(query: str) -> str:
+async def query_past_orders(query: str) -> str:
     """Search past maintenance records for similar issues."""
-    docs = vectorstore_history.similarity_search(query, k=3)
+    docs = await vectorstore_history.asimilarity_search(query, k=3)
     if not docs: return "No relevant past records found."
     return "\n".join([f"record: {d.page_content}" for d in docs])
 
 @tool
 def update_work_order(content: str, session_id: str) -> str:
     """Update the current work order draft text. Always pass the session_id."""
-    DRAFT_STORE[session_id] = content
+    with DRAFT_LOCK:
+        DRAFT_STORE[session_id] = content
     return "Draft updated. The user can see the preview."
 
 # @tool
@@ -172,81 +303,112 @@ class AgentState(TypedDict):
     # """)
     
     # return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
-def agent_node(state: AgentState):
-    # Construct Dynamic System Prompt
-    ms = state['machine_state']
-    draft_text = ms.get('current_draft_text', '')
-    rt_status = ms.get('realtime_status_msg', 'Unknown')
-    # Create a dynamic warning message
-    
-    sys_msg = SystemMessage(content=f"""
-     You are an advanced Multimodal Predictive Maintenance Copilot. 
-    YOU HAVE VISION CAPABILITIES. You CAN view photos and images. 
-    Do NOT ever state that you cannot view images or photos. When the user provides an image, you MUST actively analyze its contents.
-    
+# The prompt is split in two: a constant preamble (identical across all
+# sessions, eligible for provider-side prompt caching) and a small dynamic
+# block with only the live fields. Rules stated several times in the old
+# prompt are folded into one statement each, roughly halving input tokens.
+STATIC_PREAMBLE = """
+    You are an advanced Multimodal Predictive Maintenance Copilot.
+    YOU HAVE VISION CAPABILITIES. You CAN view photos and images. When the user provides an image, you MUST actively analyze its contents; never state that you cannot view images.
+
     # === [DOMAIN RECOGNITION & ROUTING RULES] ===
-    You monitor a specific LIVE CONVEYOR SYSTEM. However, the user may ask you about OTHER general machinery.
-    1. **Live Conveyor Queries:** If the user asks about "the machine", "the conveyor", "current status", or uploads an image clearly related to the monitored conveyor:
-       - You MUST reference the [LIVE MACHINE STATUS] provided below to correlate visual symptoms with real-time data.
-    2. **General Machinery Queries:** If the user asks general engineering questions or uploads an image of unrelated equipment (e.g., a pump, CNC spindle, broken pipe, general tool):
-       - Answer based on your broad industrial and engineering knowledge.
-       - DO NOT append or reference the live conveyor's vibration or IDK data, as it is completely irrelevant to other machines.
-
-    # !!! CRITICAL PROTOCOL FOR WORK ORDERS !!!
-    # READ THIS CAREFULLY. DO NOT HALLUCINATE.
-    
-    1. **TRIGGER:** If the user asks to "Draft", "Create", "Write", or "Update" a work order...
-    2. **ACTION:** You MUST call the tool `update_work_order` IMMEDIATELY.
-    3. **FORBIDDEN:** You are FORBIDDEN from outputting the text "I have created a draft" or "I have updated the draft" UNLESS you have actually called the tool.
-    4. **VERIFICATION:** If you do not see the tool output in your history, you have failed. Try again.
+    You monitor a specific LIVE CONVEYOR SYSTEM, but the user may ask about OTHER general machinery.
+    1. **Live Conveyor Queries:** If the user asks about "the machine", "the conveyor", "current status", or uploads an image clearly related to the monitored conveyor, reference the [LIVE MACHINE STATUS] provided below and correlate visual symptoms with the real-time data.
+    2. **General Machinery Queries:** For general engineering questions or images of unrelated equipment (e.g., a pump, CNC spindle, broken pipe), answer from your broad industrial knowledge and do NOT reference the live conveyor's vibration or IDK data.
+
+    # === [WORK ORDER PROTOCOL] ===
+    - If the user asks to "Draft", "Create", "Write", or "Update" a work order, you MUST call the tool `update_work_order` IMMEDIATELY. Never state that a draft was created or updated unless the tool output is in your history.
+    - The 'content' argument MUST include:
+      - **Incident Report:** Timestamp, Vibration, ISO Zone and IDK Anomaly status from [LIVE MACHINE STATUS].
+      - **Recommended Actions:** 3-4 numbered technical checks.
+      - **Priority:** High/Medium/Low.
+    - Work orders for the conveyor must cite both the visual evidence (if any) and the real-time sensor data.
 
     # === [VISUAL DIAGNOSIS RULES] ===
-    - If the user uploads an image of a machine part (like a conveyor belt or motor), analyze it for visible signs of wear, misalignment, or damage.
-    - If the user uploads a graph or dashboard screenshot, correlate the visual trend with the LIVE MACHINE STATUS provided below.
-    - If drafting a work order FOR THE CONVEYOR, always reference both the visual evidence and the real-time sensor data (Vibration: {ms.get('current_vibration', 'Unknown')}, Status: {ms.get('status', 'Unknown')}) when drafting a work order.
-    
-    # === [PAYLOAD CONTENT] ===
-    When calling `update_work_order`, the 'content' argument MUST include
-    - **Incident Report:** - Timestamp: {ms.get('last_update')}
-      - Vibration: {ms.get('current_vibration')}
-      - ISO Zone: {ms.get('iso_10816_status')}
-      - IDK Anomaly: {ms.get('status')}
-    - **Recommended Actions:** 3-4 numbered technical checks.
-    - **Priority:** High/Medium/Low.
-    
+    - For images of machine parts (like a conveyor belt or motor), analyze visible signs of wear, misalignment, or damage.
+    - For graph or dashboard screenshots, correlate the visual trend with [LIVE MACHINE STATUS].
+
     # === [NATURAL CONVERSATION RULES] ===
     - DO NOT use Markdown symbols like '**', '###', or '#' in your final response to the user.
-    - Use a professional, helpful, and conversational tone.
-    - Keep information organized with plain text spacing and simple dashes if needed.
-    - Treat the user like a colleague on the factory floor.
-    
-    1. **Real-Time Check:** - If {rt_status} contains "NO", warn the user politely about the delay.
-       - If {rt_status} contains "YES", confirm the data is live.
-       
-    2. **Status Explanation:**
-       - Explain the ISO 10816 Zone (Rule-based).
-       - Explain the IDK Algorithm (AI-based anomaly detection on raw data).
-    
-        
+    - Use a professional, helpful, conversational tone with plain text spacing and simple dashes; treat the user like a colleague on the factory floor.
+    - **Real-Time Check:** If the realtime status below contains "NO", warn the user politely about the delay; if it contains "YES", confirm the data is live.
+    - **Status Explanation:** Explain the ISO 10816 Zone (rule-based) and the IDK Algorithm (AI-based anomaly detection on raw data) when asked about status.
+    """
+
+# Plain string template (NOT an f-string): filled once per request via .format()
+DYNAMIC_CONTEXT = """
+    [LIVE MACHINE STATUS]
+    - Last Update: {last_update}
+    - Vibration: {current_vibration}
+    - ISO Zone: {iso_10816_status}
+    - IDK Anomaly: {status}
+    - Realtime Status: {realtime_status_msg}
+
     [CURRENT DRAFT CONTEXT]
-    - Does Draft Exist? {bool(draft_text)}
-    - Current Draft Content: 
-    '''{draft_text if draft_text else "None"}'''
+    - Does Draft Exist? {draft_exists}
+    - Current Draft Content:
+    '''{draft_text}'''
 
-    
     [CURRENT CONTEXT]
-    Session ID: {ms.get('session_id')}
-    """)
-    
-    return {"messages": [llm_with_tools.invoke([sys_msg] + state["messages"])]}
+    Session ID: {session_id}
+    """
+
+STATIC_SYS_MSG = SystemMessage(content=STATIC_PREAMBLE)
+
+# Defaults for fields the backend may not have populated yet (e.g. startup)
+_SYS_DEFAULTS = {
+    "current_vibration": "Unknown",
+    "status": "Unknown",
+    "last_update": "Unknown",
+    "iso_10816_status": "Unknown",
+    "realtime_status_msg": "Unknown",
+    "session_id": "Unknown",
+}
+
+_SYS_FIELDS = tuple(_SYS_DEFAULTS)
+
+@lru_cache(maxsize=512)
+def _build_sys(key: tuple) -> SystemMessage:
+    """Builds the dynamic-context SystemMessage for a given context tuple.
+
+    The scheduler only refreshes machine_state every few minutes, so most
+    chat turns hit the same key and reuse the already-formatted message.
+    """
+    fields = dict(zip(_SYS_FIELDS, key[:-1]))
+    draft_text = key[-1]
+    fields["draft_exists"] = bool(draft_text)
+    fields["draft_text"] = draft_text if draft_text else "None"
+    return SystemMessage(content=DYNAMIC_CONTEXT.format(**fields))
+
+async def agent_node(state: AgentState):
+    # Static preamble + cached dynamic context block
+    ms = state['machine_state']
+    key = tuple(ms.get(f, _SYS_DEFAULTS[f]) for f in _SYS_FIELDS)
+    key += (ms.get('current_draft_text', ''),)
+    sys_msgs = [STATIC_SYS_MSG, _build_sys(key)]
+
+    return {"messages": [await llm_with_tools.ainvoke(sys_msgs + state["messages"])]}
 # Build Graph
 builder = StateGraph(AgentState)
 builder.add_node("agent", agent_node)
 builder.add_node("tools", ToolNode(tools))
 
+def _route(state: AgentState):
+    """Routes to the tool node when the last message carries tool calls."""
+    m = state["messages"][-1]
+    return "tools" if getattr(m, "tool_calls", None) else END
+
 builder.set_entry_point("agent")
-builder.add_conditional_edges("agent", lambda x: "tools" if x['messages'][-1].tool_calls else END)
+builder.add_conditional_edges("agent", _route)
 builder.add_edge("tools", "agent")
 
-# Compile agent without external checkpointing to avoid serialization issues
-agent_executor = builder.compile()
\ No newline at end of file
+# Persist conversation state per thread_id in SQLite: each /api/chat call
+# only carries the new HumanMessage and LangGraph merges it onto the stored
+# history via the add_messages reducer, instead of the client replaying the
+# whole conversation every turn. The async saver is required because the
+# graph is only ever entered via ainvoke/astream_events; the connection is
+# started lazily by the saver on first use.
+checkpointer = AsyncSqliteSaver(
+    aiosqlite.connect(os.path.join(BASE_DIR, "agent_state.db"), check_same_thread=False)
+)
+agent_executor = builder.compile(checkpointer=checkpointer)
\ No newline at end of file
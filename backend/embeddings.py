@@ -0,0 +1,188 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+from typing import Optional
+
+import tiktoken
+from cachetools import TTLCache
+from langchain_openai import OpenAIEmbeddings
+from pydantic import PrivateAttr
+
+# ===================== BATCHING CONFIG =====================
+# The OpenAI embeddings API accepts up to 2048 inputs / 8191 tokens per call,
+# so collecting concurrent queries into one request amortizes the HTTP
+# round-trip across sessions instead of paying ~120ms per query.
+FLUSH_INTERVAL = 0.075   # seconds to wait for more queries before flushing
+MAX_BATCH_ITEMS = 64     # flush early once this many queries are queued
+MAX_BATCH_TOKENS = 8000  # stay safely under the 8191-token request limit
+
+
+class BatchedEmbeddings(OpenAIEmbeddings):
+    """OpenAIEmbeddings that debounces concurrent embed_query calls.
+
+    Queries arriving within the flush window are sent as a single
+    embeddings API call and each caller gets its own vector back.
+    Sync callers (e.g. Chroma's blocking search path) fall through to
+    the normal per-call behaviour.
+    """
+
+    _queue: Optional[asyncio.Queue] = PrivateAttr(default=None)
+    _flusher: Optional[asyncio.Task] = PrivateAttr(default=None)
+    _encoder = PrivateAttr(default=None)
+
+    def _ensure_worker(self):
+        # Lazy init so the queue/task bind to the running event loop
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._encoder = tiktoken.get_encoding("cl100k_base")
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def aembed_query(self, text: str) -> list[float]:
+        self._ensure_worker()
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((text, fut))
+        return await fut
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Block until at least one query arrives, then collect more
+            # until the debounce window closes or a batch cap is hit.
+            batch = [await self._queue.get()]
+            batch_tokens = len(self._encoder.encode(batch[0][0]))
+            deadline = loop.time() + FLUSH_INTERVAL
+
+            while len(batch) < MAX_BATCH_ITEMS:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    text, fut = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                tokens = len(self._encoder.encode(text))
+                if batch_tokens + tokens > MAX_BATCH_TOKENS:
+                    # Over the request token budget: flush now, requeue this one
+                    self._queue.put_nowait((text, fut))
+                    break
+                batch.append((text, fut))
+                batch_tokens += tokens
+
+            texts = [t for t, _ in batch]
+            try:
+                vectors = await super().aembed_documents(texts)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+
+            for (_, fut), vec in zip(batch, vectors):
+                if not fut.done():
+                    fut.set_result(vec)
+
+
+# ===================== EMBEDDING CACHE =====================
+# Users repeat the same diagnostic questions ("status?", "is the conveyor ok?")
+# so cache vectors by content hash and skip the API entirely on a hit.
+_EMB_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+_CACHE_LOCK = threading.Lock()
+
+# Exposed via /api/metrics for observability
+EMB_CACHE_STATS = {"hits": 0, "misses": 0}
+
+
+class CachedEmbeddings(BatchedEmbeddings):
+    """Adds a SHA-256 keyed TTL cache in front of the batched embedder.
+
+    Repeated queries (and re-ingested documents) become zero-API-call
+    cache hits; misses fall through to the batching path.
+    """
+
+    def _cache_key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model}::{text}".encode()).digest()
+
+    def _cache_get(self, key: bytes):
+        with _CACHE_LOCK:
+            vec = _EMB_CACHE.get(key)
+        if vec is not None:
+            EMB_CACHE_STATS["hits"] += 1
+        else:
+            EMB_CACHE_STATS["misses"] += 1
+        return vec
+
+    def _cache_put(self, key: bytes, vec: list[float]):
+        with _CACHE_LOCK:
+            _EMB_CACHE[key] = vec
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self._cache_key(text)
+        vec = self._cache_get(key)
+        if vec is None:
+            vec = super().embed_query(text)
+            self._cache_put(key, vec)
+        return vec
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self._cache_key(text)
+        vec = self._cache_get(key)
+        if vec is None:
+            vec = await super().aembed_query(text)
+            self._cache_put(key, vec)
+        return vec
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._cache_key(t) for t in texts]
+        vectors = [self._cache_get(k) for k in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            fresh = super().embed_documents([texts[i] for i in missing])
+            for i, vec in zip(missing, fresh):
+                vectors[i] = vec
+                self._cache_put(keys[i], vec)
+        return vectors
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [self._cache_key(t) for t in texts]
+        vectors = [self._cache_get(k) for k in keys]
+        missing = [i for i, v in enumerate(vectors) if v is None]
+        if missing:
+            fresh = await super().aembed_documents([texts[i] for i in missing])
+            for i, vec in zip(missing, fresh):
+                vectors[i] = vec
+                self._cache_put(keys[i], vec)
+        return vectors
+
+
+# ===================== PERSISTENT VECTOR SIDECAR =====================
+class VectorSidecar:
+    """sqlite-backed (content hash -> embedding) store surviving restarts.
+
+    The in-process TTL cache above covers repeats within a session;
+    this covers re-ingestion of content the server has already paid to
+    embed, e.g. re-approving the same day's work order after a restart.
+    """
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors (hash TEXT PRIMARY KEY, vec TEXT)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vec FROM vectors WHERE hash = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, vec: list[float]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO vectors VALUES (?, ?)", (key, json.dumps(vec))
+            )
+            self._conn.commit()
@@ -1,12 +1,29 @@
+import asyncio
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from apscheduler.schedulers.background import BackgroundScheduler
 from pydantic import BaseModel
-from chat_engine import agent_executor, DRAFT_STORE, vectorstore_history
+from chat_engine import (
+    agent_executor,
+    DRAFT_STORE,
+    DRAFT_LOCK,
+    vectorstore_history,
+    persist_history,
+    iter_history_documents,
+    init_manual,
+    embeddings,
+    vector_sidecar,
+)
+from embeddings import EMB_CACHE_STATS
 from langchain_core.messages import HumanMessage
+from langchain_core.documents import Document
 from dotenv import load_dotenv 
 from typing import Optional
 
@@ -15,7 +32,9 @@ from ml_engine import run_pipeline, load_conveyor_data, TARGETS
 
 load_dotenv()
 
-app = FastAPI(title="Predictive Maintenance API")
+# orjson serializes (and handles numpy arrays) several times faster than
+# the stdlib json encoder FastAPI defaults to
+app = FastAPI(title="Predictive Maintenance API", default_response_class=ORJSONResponse)
 
 # ===================== 1. CONFIGURATION =====================
 
@@ -38,8 +57,73 @@ class MachineState:
 
 state = MachineState()
 
+# ISO 10816 vibration severity lookup (shared by summary and chat context).
+# searchsorted on the zone edges replaces the duplicated if/elif ladders and
+# also works vectorized when given a whole z_rms array.
+_ISO_EDGES = np.array([0.71, 1.8, 4.5])
+_ISO_ZONES = ("A", "B", "C", "D")
+_ISO_STATUS = ("Good", "Acceptable", "Unsatisfactory", "Unacceptable")
+
+def iso_zone(z_rms):
+    """Maps an RMS velocity (mm/s) to its ISO 10816 (zone, status) pair."""
+    i = int(np.searchsorted(_ISO_EDGES, z_rms, side="right"))
+    return _ISO_ZONES[i], _ISO_STATUS[i]
+
+# The scheduler only refreshes `state` every 5 minutes, so everything derived
+# from the last sensor row (latest values, ISO zone, error flags) is fully
+# cacheable between ticks. Both /api/summary and chat_endpoint read this.
+_SNAPSHOT = {"last_update": None, "payload": None}
+
+# Precomputed once: per-request f-string formatting of these names was
+# pure overhead on the chat path
+_ERROR_FLAG_COLS = [f"{t}_error_flag" for t in TARGETS]
+_TARGETS_ARR = np.array(TARGETS)
+
+# Sensor timestamps are naive UTC+8 (Asia/Singapore)
+_TZ_OFFSET = pd.Timedelta(hours=8)
+
+def _snapshot():
+    """Returns derived last-row state, recomputed only after a scheduler run."""
+    if _SNAPSHOT["last_update"] != state.last_update:
+        latest = state.data.iloc[-1]
+        z_rms = latest.get("z_rms", 0)
+        zone, status = iso_zone(z_rms)
+
+        # Single vectorized scan over the flag columns (missing ones -> False)
+        flags = latest.reindex(_ERROR_FLAG_COLS).fillna(False).to_numpy(dtype=bool)
+        error_sensors = _TARGETS_ARR[flags].tolist()
+        if error_sensors:
+            data_quality_msg = f"WARNING: Sensor Reading Error detected for {', '.join(error_sensors)}. Data is currently interpolated."
+        else:
+            data_quality_msg = "All sensors are reporting normally."
+
+        _SNAPSHOT["payload"] = {
+            "metrics": latest.to_dict(),
+            "sensor_time": latest.name,      # pandas Timestamp of last reading
+            "data_timestamp": str(latest.name),
+            "z_rms": z_rms,
+            "iso_zone": zone,
+            "status": status,
+            "iso_status": f"Zone {zone} ({status})",
+            "data_quality_msg": data_quality_msg,
+            # IDK status of the first target, resolved once per tick instead
+            # of materializing the values view on every chat request
+            "anomaly_status": (
+                "Anomaly"
+                if state.anomalies and state.anomalies[next(iter(state.anomalies))][-1] < 0.05
+                else "Normal"
+            ),
+        }
+        _SNAPSHOT["last_update"] = state.last_update
+    return _SNAPSHOT["payload"]
+
 # ===================== 2. REAL-TIME SCHEDULER =====================
 
+# The retrain pipeline (LightGBM + IDK + forecast) runs in a dedicated
+# subprocess so it does not share the GIL with request handlers — chat and
+# summary endpoints stay responsive during the 5-minute refresh.
+_PIPELINE_POOL = ProcessPoolExecutor(max_workers=1)
+
 def update_machine_state():
     """
     Worker function: Runs in the background.
@@ -61,7 +145,9 @@ def update_machine_state():
         # Run the full ML Pipeline (Training + IDK + Forecast)
         # In a real heavy production system, you might only 'predict' here and 'train' nightly.
         # For this prototype, we do everything to keep it simple.
-        state.data, state.forecast, state.anomalies, state.importance, state.models = run_pipeline(df)
+        # Submitted to the worker subprocess; Boosters pickle fine across it.
+        fut = _PIPELINE_POOL.submit(run_pipeline, df)
+        state.data, state.forecast, state.anomalies, state.importance, state.models = fut.result()
         
         state.last_update = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         print(f"[INFO] Scheduler updated successfully. Last data point: {df.index[-1]}")
@@ -69,6 +155,11 @@ def update_machine_state():
     except Exception as e:
         print(f"[ERROR] Scheduler update failed: {str(e)}")
 
+@app.on_event("startup")
+async def start_manual_ingestion():
+    """Schedules manual PDF ingestion in the background (non-blocking)."""
+    asyncio.create_task(init_manual())
+
 @app.on_event("startup")
 def start_realtime_system():
     """Initializes the system and starts the background timer."""
@@ -92,31 +183,15 @@ def get_summary():
     """Returns the latest sensor values and overall machine status."""
     if state.data is None:
         raise HTTPException(status_code=503, detail="System initializing, please wait...")
-    
-    latest = state.data.iloc[-1]
-    
-    # Calculate ISO 10816 Zone (Simple Logic)
-    z_rms = latest.get("z_rms", 0)
-    
-    if z_rms < 0.71:
-        iso_zone = "A" 
-        status = "Good"
-    elif z_rms < 1.8:
-        iso_zone = "B"
-        status = "Acceptable"
-    elif z_rms < 4.5:
-        iso_zone = "C"
-        status = "Unsatisfactory"
-    else:
-        iso_zone = "D"
-        status = "Unacceptable"
-    
+
+    snap = _snapshot()
+
     return {
         "timestamp": state.last_update,  # The time the AI actually ran
-        "data_timestamp": str(latest.name), # The time of the sensor reading
-        "metrics": latest.to_dict(),
-        "status": status,
-        "iso_zone": iso_zone,
+        "data_timestamp": snap["data_timestamp"], # The time of the sensor reading
+        "metrics": snap["metrics"],
+        "status": snap["status"],
+        "iso_zone": snap["iso_zone"],
         "machine_status": getattr(state, "status", "Unknown"),
     }
 
@@ -134,15 +209,17 @@ def get_forecast(target: str):
     flags = state.data[f"{target}_error_flag"].iloc[-48:]
     # Get Forecast Data
     prediction = state.forecast[target]
-    
-    return {
-        "history_x": history.index.astype(str).tolist(),
-        "history_y": history.values.tolist(),
-        "history_flags": flags.values.tolist(),
-        "forecast_x": prediction.index.astype(str).tolist(),
-        "forecast_y": prediction.values.tolist(),
+
+    # Return ORJSONResponse directly with raw float32 arrays: orjson writes
+    # numpy buffers straight into the JSON output, no per-element boxing
+    return ORJSONResponse({
+        "history_x": history.index.strftime("%Y-%m-%d %H:%M:%S").tolist(),
+        "history_y": history.to_numpy(dtype=np.float32),
+        "history_flags": flags.to_numpy(dtype=bool),
+        "forecast_x": prediction.index.strftime("%Y-%m-%d %H:%M:%S").tolist(),
+        "forecast_y": prediction.to_numpy(dtype=np.float32),
         "unit": "mm/s" if "rms" in target else "°C" if "temp" in target else "A"
-    }
+    })
 
 @app.get("/api/anomalies/{target}")
 def get_anomalies(target: str):
@@ -186,9 +263,55 @@ def get_importance():
          return {}
     return state.importance
 
+@app.get("/api/metrics")
+def get_metrics():
+    """Returns internal performance counters (embedding cache hit rate)."""
+    total = EMB_CACHE_STATS["hits"] + EMB_CACHE_STATS["misses"]
+    return {
+        "embedding_cache": {
+            **EMB_CACHE_STATS,
+            "hit_rate": (EMB_CACHE_STATS["hits"] / total) if total else 0.0,
+        }
+    }
+
 
 # ===================== 4. WORK ORDER HISTORY ENDPOINTS =====================
 
+# In-memory index of saved work orders keyed by canonical id, built once
+# from the docstore and updated in approve_work_order. List/get reads are
+# O(1) dict lookups instead of rescanning the whole store per page load.
+_WO_CACHE = None
+
+def _wo_item(wid: str, created_at: str | None, full_text: str, metadata: dict | None = None):
+    # Clean formatting for UI (remove '*' markdown artifacts)
+    text_clean = (full_text or "").replace("*", "")
+    return {
+        "id": wid,
+        "created_at": created_at,
+        "preview": text_clean[:260],
+        "content": text_clean,
+        "metadata": metadata or {},
+    }
+
+def _wo_cache() -> dict:
+    """Returns the work-order cache, building it on first access."""
+    global _WO_CACHE
+    if _WO_CACHE is None:
+        cache = {}
+        for d in iter_history_documents():
+            meta = d.metadata or {}
+            wid = meta.get("id", "")
+            # Only expose canonical work orders to the UI
+            if not wid.startswith("work_order_"):
+                continue
+            created_at = meta.get("created_at")
+            # Keep the newest record per work_order_xxx
+            prev = cache.get(wid)
+            if not prev or (created_at or "") > (prev.get("created_at") or ""):
+                cache[wid] = _wo_item(wid, created_at, d.page_content or "", meta)
+        _WO_CACHE = cache
+    return _WO_CACHE
+
 @app.get("/api/work_orders")
 def list_work_orders(q: str | None = None):
     """
@@ -196,61 +319,31 @@ def list_work_orders(q: str | None = None):
     If 'q' is provided, performs a similarity search over work orders.
     """
     try:
-        items = []
-
-        def _add_item(wid: str, created_at: str | None, full_text: str):
-            # Only expose canonical work orders to the UI
-            if not wid.startswith("work_order_"):
-                return
-
-            # Clean formatting for UI (remove '*' markdown artifacts)
-            text_clean = (full_text or "").replace("*", "")
-
-            items.append(
-                {
-                    "id": wid,
-                    "created_at": created_at,
-                    "preview": text_clean[:260],
-                    "content": text_clean,
-                }
-            )
+        cache = _wo_cache()
 
         if q:
             docs = vectorstore_history.similarity_search(q, k=50)
+            hits, seen = [], set()
             for d in docs:
-                meta = d.metadata or {}
-                wid = meta.get("id", "")
-                created_at = meta.get("created_at")
-                _add_item(wid, created_at, d.page_content or "")
+                wid = (d.metadata or {}).get("id", "")
+                if wid in cache and wid not in seen:
+                    seen.add(wid)
+                    hits.append(cache[wid])
+            items = hits  # preserve relevance order
         else:
-            # Use underlying Chroma collection to fetch all documents
-            raw = vectorstore_history._collection.get()  # type: ignore[attr-defined]
-            ids = raw.get("ids", []) or []
-            docs = raw.get("documents", []) or []
-            metas = raw.get("metadatas", []) or []
-
-            for i, doc in enumerate(docs):
-                meta = metas[i] if metas and i < len(metas) else {}
-                wid = meta.get("id", ids[i] if i < len(ids) else "")
-                created_at = meta.get("created_at")
-                _add_item(wid, created_at, doc or "")
-
-        # Deduplicate by ID (keep the newest per work_order_xxx)
-        dedup = {}
-        for it in items:
-            wid = it["id"]
-            prev = dedup.get(wid)
-            if not prev or (it.get("created_at") or "") > (prev.get("created_at") or ""):
-                dedup[wid] = it
-
-        items_uniq = list(dedup.values())
-
-        # Sort newest first if timestamps exist
-        items_uniq.sort(
-            key=lambda x: x.get("created_at") or "",
-            reverse=True,
-        )
-        return {"items": items_uniq}
+            items = sorted(
+                cache.values(),
+                key=lambda x: x.get("created_at") or "",
+                reverse=True,
+            )
+
+        # Strip the internal metadata field from the list payload
+        return {
+            "items": [
+                {k: it[k] for k in ("id", "created_at", "preview", "content")}
+                for it in items
+            ]
+        }
     except Exception as e:
         print(f"[ERROR] Failed to list work orders: {e}")
         return {"items": []}
@@ -262,14 +355,10 @@ def get_work_order(work_id: str):
     Returns the full content of a specific work order by its metadata 'id'.
     """
     try:
-        raw = vectorstore_history._collection.get(  # type: ignore[attr-defined]
-            where={"id": work_id}
-        )
-        docs = raw.get("documents") or []
-        metas = raw.get("metadatas") or []
-
-        if not docs:
-            # Fallback: approximate search if direct filter fails
+        item = _wo_cache().get(work_id)
+
+        if item is None:
+            # Fallback: approximate search if direct lookup fails
             hits = vectorstore_history.similarity_search(work_id, k=1)
             if not hits:
                 raise HTTPException(status_code=404, detail="Work order not found")
@@ -281,13 +370,11 @@ def get_work_order(work_id: str):
                 "metadata": d.metadata,
             }
 
-        doc = docs[0]
-        meta = metas[0] if metas else {}
         return {
-            "id": meta.get("id", work_id),
-            "created_at": meta.get("created_at"),
-            "content": doc,
-            "metadata": meta,
+            "id": item["id"],
+            "created_at": item["created_at"],
+            "content": item["content"],
+            "metadata": item["metadata"],
         }
     except HTTPException:
         raise
@@ -302,12 +389,10 @@ class ChatRequest(BaseModel):
     session_id: str
     image_base64: Optional[str] = None # New field for the image
 
-#@app.post("/api/chat")
-@app.post("/api/chat")
-def chat_endpoint(req: ChatRequest):
+def _build_chat_input(req: ChatRequest):
     """
-    Handles Chat Interaction.
-    Injects the LATEST machine state into the AI context.
+    Prepares the (message_content, machine_state) pair for the agent.
+    Shared by the blocking and streaming chat endpoints.
     """
 
     # 1. Prepare the Live Context
@@ -325,40 +410,26 @@ def chat_endpoint(req: ChatRequest):
             "current_draft_text": existing_draft,
         }
     else:
-        # --- NEW: CALCULATE ISO ZONE HERE ---
-        latest = state.data.iloc[-1]
-        # Check if ANY of the target sensors are currently flagged as an error
-        error_sensors = [tgt for tgt in TARGETS if latest.get(f"{tgt}_error_flag") == True]
-        if error_sensors:
-            data_quality_msg = f"WARNING: Sensor Reading Error detected for {', '.join(error_sensors)}. Data is currently interpolated."
-        else:
-            data_quality_msg = "All sensors are reporting normally."
-        z_rms = latest.get("z_rms", 0)
-        sensor_time = latest.name  # This is a pandas Timestamp
-        now_my = datetime.utcnow() + timedelta(hours=8)
+        # Derived last-row values are shared with /api/summary via the snapshot
+        snap = _snapshot()
+        sensor_time = snap["sensor_time"]  # This is a pandas Timestamp
+        now_my = pd.Timestamp.now("UTC").tz_localize(None) + _TZ_OFFSET
 
-        # Calculate time difference in minutes
-        diff = now_my - sensor_time
-        minutes_ago = int(diff.total_seconds() / 60)
+        # Time difference in whole minutes via integer-nanosecond arithmetic
+        minutes_ago = int((now_my - sensor_time).value // 60_000_000_000)
         if minutes_ago > 30:
             realtime_status = f"NO. The data is NOT real-time. It is {minutes_ago} minutes old (Timestamp: {sensor_time})."
         else:
             realtime_status = f"YES. The data is real-time ({minutes_ago} mins delay)."
-        
-        if z_rms < 0.71: iso_status = "Zone A (Good)"
-        elif z_rms < 1.8: iso_status = "Zone B (Acceptable)"
-        elif z_rms < 4.5: iso_status = "Zone C (Unsatisfactory)"
-        else: iso_status = "Zone D (Unacceptable)"
-    
-    
+
         current_context = {
-            "last_update": str(latest.name),
-            "data_quality_warning": data_quality_msg,
+            "last_update": snap["data_timestamp"],
+            "data_quality_warning": snap["data_quality_msg"],
             "minutes_ago": minutes_ago,   # <--- Pass the gap
             "realtime_status_msg": realtime_status,
-            "status": "Anomaly" if state.anomalies and list(state.anomalies.values())[0][-1] < 0.05 else "Normal",
-            "iso_10816_status": iso_status, 
-            "current_vibration": f"{z_rms} mm/s",
+            "status": snap["anomaly_status"],
+            "iso_10816_status": snap["iso_status"],
+            "current_vibration": f"{snap['z_rms']} mm/s",
             "is_anomaly": True,  # You can make this dynamic based on real threshold logic
             # Pass through session id so tools can use it without asking the user
             "session_id": req.session_id,
@@ -393,11 +464,21 @@ def chat_endpoint(req: ChatRequest):
         # CRITICAL FIX: If there is no image, just pass the plain text string
         message_content = req.message
 
+    return message_content, current_context
+
+@app.post("/api/chat")
+async def chat_endpoint(req: ChatRequest):
+    """
+    Handles Chat Interaction.
+    Injects the LATEST machine state into the AI context.
+    """
+    message_content, current_context = _build_chat_input(req)
+
     # 3. Run the LangGraph Agent
     # 'thread_id' is used by LangGraph to remember conversation history
     config = {"configurable": {"thread_id": req.session_id}}
 
-    output = agent_executor.invoke(
+    output = await agent_executor.ainvoke(
         {
             "messages": [HumanMessage(content=message_content)],
             "machine_state": current_context
@@ -419,6 +500,37 @@ def chat_endpoint(req: ChatRequest):
         "draft": current_draft
     }
 
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(req: ChatRequest):
+    """
+    Streaming variant of /api/chat using Server-Sent Events.
+    Tokens are flushed as the model generates them, so the user sees the
+    first words in well under a second instead of waiting for the full reply.
+    """
+    message_content, current_context = _build_chat_input(req)
+    config = {"configurable": {"thread_id": req.session_id}}
+
+    async def _gen():
+        async for ev in agent_executor.astream_events(
+            {
+                "messages": [HumanMessage(content=message_content)],
+                "machine_state": current_context,
+            },
+            config=config,
+            version="v2",
+        ):
+            if ev["event"] == "on_chat_model_stream":
+                chunk = ev["data"]["chunk"].content
+                if chunk and isinstance(chunk, str):
+                    # Markdown stripping happens per-chunk in the stream
+                    delta = chunk.replace("**", "").replace("###", "").replace("#", "")
+                    yield f"data: {json.dumps({'delta': delta})}\n\n"
+
+        # Final event carries the (possibly updated) draft for the UI preview
+        yield f"data: {json.dumps({'done': True, 'draft': DRAFT_STORE.get(req.session_id, '')})}\n\n"
+
+    return StreamingResponse(_gen(), media_type="text/event-stream")
+
 class ApprovalRequest(BaseModel):
     session_id: str
 
@@ -441,11 +553,14 @@ def approve_work_order(req: ApprovalRequest):
     canonical_id = f"work_order_{today_str}"
 
     # 3. Check for duplicates (Optional: Logic to append instead of skip)
-    existing = vectorstore_history._collection.get(where={"id": canonical_id})
-    if existing and existing.get("documents"):
+    existing = [
+        d for d in iter_history_documents()
+        if (d.metadata or {}).get("id") == canonical_id
+    ]
+    if existing:
          # For this demo, we append to the existing day's log
          # In production, you might want distinct IDs like work_order_DATE_001
-         pass 
+         pass
 
     # 4. Save to Vector DB
     doc = Document(
@@ -457,9 +572,26 @@ def approve_work_order(req: ApprovalRequest):
             "status": "human_approved" # Tag it!
         },
     )
-    vectorstore_history.add_documents([doc])
+    # Reuse a persisted embedding for identical content (common when the
+    # same day's order is re-approved) instead of re-calling the API
+    content_hash = hashlib.sha256(content_clean.encode()).hexdigest()
+    vec = vector_sidecar.get(content_hash)
+    if vec is None:
+        vec = embeddings.embed_documents([content_clean])[0]
+        vector_sidecar.put(content_hash, vec)
+
+    vectorstore_history.add_embeddings(
+        [(content_clean, vec)], metadatas=[doc.metadata]
+    )
+    persist_history()
+
+    # Keep the in-memory index current (no rescan needed)
+    _wo_cache()[canonical_id] = _wo_item(
+        canonical_id, doc.metadata["created_at"], content_clean, doc.metadata
+    )
 
     # 5. Clear the Draft
-    DRAFT_STORE[req.session_id] = ""
+    with DRAFT_LOCK:
+        DRAFT_STORE[req.session_id] = ""
 
     return {"status": "success", "work_order_id": canonical_id}
\ No newline at end of file